@@ -1,6 +1,16 @@
 import argparse
+import asyncio
+import hashlib
+import itertools
 import os
+import re
+import shelve
+import time
+import httpx
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from datetime import datetime
 
 # Usage: summary.py filename -s 1-5 [-k] [-c context length]
@@ -17,37 +27,364 @@ BASE_SYSTEM_PROMPT = (
     "and instead focus on narrative and chronology "
 )
 
+# The mode switch goes at the end so every call shares the same prompt prefix,
+# which lets the backend reuse its cached KV for the system prompt.
+SYS_THINK = BASE_SYSTEM_PROMPT + "/think"
+SYS_NOTHINK = BASE_SYSTEM_PROMPT + "/nothink"
+
+# Approximate word counts for summary levels 1-4; a master summary already
+# within 20% of the target is used as-is instead of being compressed again
+TARGET_WORDS = {1: 350, 2: 750, 3: 1500, 4: 2500}
+
+# Request bodies are encoded with orjson, so the content type is set by hand
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+# Gateway statuses retried on both the sync and async clients
+RETRY_STATUSES = (502, 503, 504)
+RETRY_TOTAL = 3
+RETRY_BACKOFF = 0.5
+
+# -------------------------
+# Async helpers
+# -------------------------
+async def gather_bounded(coros, limit):
+    # Like asyncio.gather, but with at most `limit` coroutines running at once.
+    # `coros` may be a lazy iterable: it is only advanced when a slot frees up,
+    # so a generator of chunk prompts never has more than `limit` chunks in memory.
+    # Results are returned in submission order.
+    sem = asyncio.Semaphore(limit)
+
+    async def _bounded(coro):
+        try:
+            return await coro
+        finally:
+            sem.release()
+
+    tasks = []
+    coros = iter(coros)
+    while True:
+        await sem.acquire()
+        coro = next(coros, None)
+        if coro is None:
+            sem.release()
+            break
+        tasks.append(asyncio.create_task(_bounded(coro)))
+
+    return await asyncio.gather(*tasks)
+
+def batched(iterable, n):
+    # Lazily groups an iterable into lists of up to n items (itertools.batched is 3.12+)
+    it = iter(iterable)
+    while batch := list(itertools.islice(it, n)):
+        yield batch
+
 # -------------------------
 # Generic LLM Client
 # -------------------------
+class StreamInterrupted(Exception):
+    # Raised by chat_stream() when a response breaks off before the backend finishes it
+    pass
+
 class LLMClient:
-    def __init__(self, base_url="http://127.0.0.1:1234/v1", model="local-model"):
+    def __init__(self, base_url="http://127.0.0.1:1234/v1", model="local-model", batch=False, concurrency=4):
         # Default points to LM Studio
-        self.url = f"{base_url.rstrip('/')}/chat/completions"
+        base_url = base_url.rstrip('/')
+        self.base_url = base_url
+        self.url = f"{base_url}/chat/completions"
+        self.completions_url = f"{base_url}/completions"
+        self.models_url = f"{base_url}/models"
         self.model = model
-
-    def chat(self, prompt, max_tokens=1000, temperature=0, system_prompt=None, timeout=300):
+        self.batch = batch  # opt-in, see supports_batch
+        self.concurrency = concurrency  # max requests in flight on the async path
+        self._supports_batch = None
+
+        # Persistent session so sequential calls reuse the same keep-alive socket
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=16,
+            pool_maxsize=16,
+            # Only connect errors and gateway statuses are retried. POST is not
+            # idempotent here: a read timeout means the backend may still be
+            # generating, so re-sending it would queue duplicate generations.
+            max_retries=Retry(total=RETRY_TOTAL, read=0, other=0, backoff_factor=RETRY_BACKOFF,
+                              status_forcelist=RETRY_STATUSES,
+                              allowed_methods=None),  # default excludes POST
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        # Created lazily inside the running event loop, see chat_async()
+        self._async_session = None
+
+        # Responses keyed by request content, backend and model name. Set
+        # SUMMARIZE_CACHE=1 to also persist them across runs in cache_<model>.*
+        # (the extension depends on the dbm backend shelve picks);
+        # that assumes the model name really identifies the loaded model.
+        self._cache = {}
+        self._disk_cache = None
+        if os.environ.get("SUMMARIZE_CACHE"):
+            safe_model = re.sub(r"[^\w.-]", "_", model)
+            self._disk_cache = shelve.open(f"cache_{safe_model}")
+
+    def close(self):
+        self.session.close()
+        if self._disk_cache is not None:
+            self._disk_cache.close()
+            self._disk_cache = None
+
+    async def aclose(self):
+        if self._async_session is not None:
+            await self._async_session.aclose()
+            self._async_session = None
+
+    # `async with client:` scopes the shared async session to one event loop run
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    def _payload(self, prompt, max_tokens, temperature, system_prompt):
         messages = []
         if system_prompt:
             messages.append({"role": "system", "content": system_prompt})
         messages.append({"role": "user", "content": prompt})
 
-        payload = {
+        return {
             "model": self.model,
             "messages": messages,
             "max_tokens": max_tokens,
             "temperature": temperature,
         }
 
+    def _cache_key(self, prompt, max_tokens, temperature, system_prompt):
+        return hashlib.blake2b(
+            (system_prompt or "").encode() + b"\x00" + prompt.encode()
+            + f"|{max_tokens}|{temperature}|{self.model}|{self.base_url}".encode(),
+            digest_size=16,
+        ).hexdigest()
+
+    def _cache_get(self, key):
+        if key not in self._cache and self._disk_cache is not None and key in self._disk_cache:
+            self._cache[key] = self._disk_cache[key]
+        return self._cache.get(key)
+
+    def _cache_put(self, key, content):
+        if not content:
+            return  # never remember a failed call
+        self._cache[key] = content
+        if self._disk_cache is not None:
+            self._disk_cache[key] = content
+
+    def chat(self, prompt, max_tokens=1000, temperature=0, system_prompt=None, timeout=300):
+        key = self._cache_key(prompt, max_tokens, temperature, system_prompt)
+        cached = self._cache_get(key)
+        if cached is not None:
+            return cached
+
+        payload = self._payload(prompt, max_tokens, temperature, system_prompt)
+
         try:
-            response = requests.post(self.url, json=payload, timeout=timeout)
+            response = self.session.post(self.url, data=orjson.dumps(payload),
+                                         headers=JSON_HEADERS, timeout=timeout)
             response.raise_for_status()
-            data = response.json()
-            return data["choices"][0]["message"]["content"].strip()
+            data = orjson.loads(response.content)
+            content = data["choices"][0]["message"]["content"].strip()
+            self._cache_put(key, content)
+            return content
         except (requests.exceptions.RequestException, ValueError, KeyError) as e:
             print(f"❌ Error contacting backend at {self.url}: {e}")
             return ""
 
+    def chat_stream(self, prompt, max_tokens=1000, temperature=0, system_prompt=None, timeout=300):
+        # Yields the response text piece by piece as the backend generates it (SSE streaming).
+        # Raises StreamInterrupted if the stream fails or ends early, so callers
+        # never mistake a partial response for a complete one.
+        key = self._cache_key(prompt, max_tokens, temperature, system_prompt)
+        cached = self._cache_get(key)
+        if cached is not None:
+            yield cached
+            return
+
+        payload = self._payload(prompt, max_tokens, temperature, system_prompt)
+        payload["stream"] = True
+
+        parts = []
+        finished = False
+        try:
+            with self.session.post(self.url, data=orjson.dumps(payload), headers=JSON_HEADERS,
+                                   timeout=timeout, stream=True) as response:
+                response.raise_for_status()
+                for line in response.iter_lines():
+                    if not line.startswith(b"data:"):
+                        continue
+                    data = line[len(b"data:"):].strip()
+                    if data == b"[DONE]":
+                        finished = True
+                        break
+                    choices = orjson.loads(data).get("choices")
+                    if not choices:
+                        continue  # usage-only event some servers send before [DONE]
+                    if choices[0].get("finish_reason"):
+                        finished = True
+                    piece = choices[0].get("delta", {}).get("content")
+                    if piece:
+                        parts.append(piece)
+                        yield piece
+        except (requests.exceptions.RequestException, ValueError, KeyError, AttributeError) as e:
+            print(f"❌ Error contacting backend at {self.url}: {e}")
+            raise StreamInterrupted(str(e)) from e
+
+        if not finished:
+            print(f"❌ Stream from {self.url} ended before the response was complete")
+            raise StreamInterrupted("stream ended early")
+
+        self._cache_put(key, "".join(parts).strip())
+
+    async def _chat_async(self, session, prompt, max_tokens=1000, temperature=0, system_prompt=None, timeout=300):
+        key = self._cache_key(prompt, max_tokens, temperature, system_prompt)
+        cached = self._cache_get(key)
+        if cached is not None:
+            return cached
+
+        payload = self._payload(prompt, max_tokens, temperature, system_prompt)
+
+        try:
+            response = await self._post_async(session, self.url, payload, timeout)
+            response.raise_for_status()
+            data = orjson.loads(response.content)
+            content = data["choices"][0]["message"]["content"].strip()
+            self._cache_put(key, content)
+            return content
+        except (httpx.HTTPError, ValueError, KeyError) as e:
+            # repr, because httpx timeouts stringify to ""
+            print(f"❌ Error contacting backend at {self.url}: {e!r}")
+            return ""
+
+    def _get_async_session(self):
+        # All concurrent calls share one client; callers use `async with client:`
+        # so it is closed before their event loop ends.
+        # httpx only negotiates HTTP/2 over TLS, so https backends that support h2
+        # multiplex every in-flight request on one connection. Plain http backends
+        # (like the LM Studio default) use pooled HTTP/1.1 keep-alive connections,
+        # so keep as many alive as can be in flight.
+        # The transport retries connect errors; gateway statuses are retried in _post_async.
+        if self._async_session is None:
+            self._async_session = httpx.AsyncClient(
+                transport=httpx.AsyncHTTPTransport(
+                    http2=True,
+                    retries=RETRY_TOTAL,
+                    limits=httpx.Limits(max_keepalive_connections=max(16, self.concurrency),
+                                        max_connections=max(16, self.concurrency)),
+                ),
+            )
+        return self._async_session
+
+    async def _post_async(self, session, url, payload, timeout):
+        # Same policy as the sync session's Retry: 502/503/504 are retried with
+        # backoff, read timeouts are not (the backend may still be generating).
+        # A backend that runs one generation at a time queues the other in-flight
+        # requests, so the read timeout allows for waiting behind all of them;
+        # waiting for one of our own pooled connections is not bounded at all.
+        body = orjson.dumps(payload)
+        timeouts = httpx.Timeout(timeout, read=timeout * self.concurrency, pool=None)
+        for attempt in range(RETRY_TOTAL + 1):
+            response = await session.post(url, content=body, headers=JSON_HEADERS, timeout=timeouts)
+            if response.status_code not in RETRY_STATUSES or attempt == RETRY_TOTAL:
+                return response
+            await asyncio.sleep(RETRY_BACKOFF * 2 ** attempt)
+
+    async def chat_async(self, prompt, **kwargs):
+        return await self._chat_async(self._get_async_session(), prompt, **kwargs)
+
+    @property
+    def supports_batch(self):
+        # Only when requested with --batch, then probed once. vLLM accepts a list
+        # of prompts on /completions, but that endpoint skips the chat template, and
+        # vLLM already batches concurrent chat requests, so this is never the default.
+        if self._supports_batch is None:
+            self._supports_batch = False
+            if self.batch:
+                try:
+                    response = self.session.get(self.models_url, timeout=10)
+                    response.raise_for_status()
+                    models = orjson.loads(response.content).get("data", [])
+                    self._supports_batch = any(m.get("owned_by") == "vllm" for m in models)
+                except (requests.exceptions.RequestException, ValueError, AttributeError):
+                    pass
+                if not self._supports_batch:
+                    print("CAUTION:  --batch needs a vLLM backend, sending chunks as chat requests instead.")
+        return self._supports_batch
+
+    async def chat_batch(self, prompts, max_tokens=1000, temperature=0, system_prompt=None, timeout=300):
+        # Sends several prompts in one fused /completions request when the backend
+        # supports it, otherwise falls back to concurrent chat calls.
+        if not self.supports_batch:
+            return list(await asyncio.gather(*(
+                self.chat_async(p, max_tokens=max_tokens, temperature=temperature,
+                                system_prompt=system_prompt, timeout=timeout)
+                for p in prompts)))
+
+        keys = [self._cache_key(p, max_tokens, temperature, system_prompt) for p in prompts]
+        results = [self._cache_get(k) for k in keys]
+        missing = [j for j, r in enumerate(results) if r is None]
+        if not missing:
+            return results
+
+        # /completions takes raw text, so the system prompt is prepended to each prompt
+        payload = {
+            "model": self.model,
+            "prompt": [f"{system_prompt}\n\n{prompts[j]}" if system_prompt else prompts[j]
+                       for j in missing],
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+        }
+
+        try:
+            response = await self._post_async(self._get_async_session(), self.completions_url,
+                                              payload, timeout)
+            response.raise_for_status()
+            data = orjson.loads(response.content)
+            for choice in data["choices"]:
+                j = missing[choice["index"]]
+                results[j] = choice["text"].strip()
+                self._cache_put(keys[j], results[j])
+        except (httpx.HTTPError, ValueError, KeyError, IndexError) as e:
+            print(f"❌ Error contacting backend at {self.completions_url}: {e!r}")
+
+        return [r or "" for r in results]
+
+    async def chat_many(self, prompts, concurrency=None, on_done=None, max_tokens=1000, batch_size=1, **kwargs):
+        # Fire the prompts concurrently over one pooled session, at most
+        # `concurrency` (default: the client's) in flight. Results come back in submission order.
+        # `max_tokens` may be a callable taking the prompt, for per-prompt budgets.
+        # `on_done(i, result)` is called as each prompt completes, in completion order.
+        # With batch_size > 1, prompts are sent in groups through chat_batch().
+        def _budget(prompt):
+            return max_tokens(prompt) if callable(max_tokens) else max_tokens
+
+        async def _run(i, prompt):
+            result = await self.chat_async(prompt, max_tokens=_budget(prompt), **kwargs)
+            if on_done:
+                on_done(i, result)
+            return result
+
+        async def _run_batch(first, batch):
+            results = await self.chat_batch(batch, max_tokens=max(map(_budget, batch)), **kwargs)
+            if on_done:
+                for i, result in enumerate(results, start=first):
+                    on_done(i, result)
+            return results
+
+        concurrency = concurrency or self.concurrency
+        if batch_size > 1:
+            batches = await gather_bounded(
+                (_run_batch(n * batch_size + 1, b) for n, b in enumerate(batched(prompts, batch_size))),
+                limit=concurrency)
+            return [result for batch in batches for result in batch]
+        return await gather_bounded((_run(i, p) for i, p in enumerate(prompts, start=1)),
+                                    limit=concurrency)
+
 # -------------------------
 # Argument parsing
 # -------------------------
@@ -68,6 +405,12 @@ def parse_arguments():
                         help="Base URL for the backend (default: LM Studio at 127.0.0.1:1234)")
     parser.add_argument("--model", type=str, default="local-model",
                         help="Model name (default: 'local-model')")
+    parser.add_argument("--concurrency", type=int, default=4, metavar="N",
+                        help="Maximum chunk/group requests in flight (default: 4). "
+                             "Backends that run one generation at a time simply queue them")
+    parser.add_argument("--batch", action="store_true",
+                        help="vLLM only: send chunk prompts 4 at a time in one raw /completions request. "
+                             "Bypasses the chat template, so summaries may differ from the chat path")
 
     args = parser.parse_args()
 
@@ -75,24 +418,55 @@ def parse_arguments():
         parser.error(f"File not found: '{args.filename}'")
     if args.summary < 1 or args.summary > 5:
         parser.error("Summary level must be between 1 and 5")
+    if args.concurrency < 1:
+        parser.error("Concurrency must be at least 1")
 
-    return args.summary, args.filename, args.keep, args.context, args.base_url, args.model
+    return args.summary, args.filename, args.keep, args.context, args.base_url, args.model, args.batch, args.concurrency
 
 # -------------------------
 # Chunk text helper
 # -------------------------
-def chunk_text(text, chunk_size_tokens=35000, overlap_tokens=500):
-    chars_per_token = 4  # heuristic
-    chunk_size = chunk_size_tokens * chars_per_token
-    overlap = overlap_tokens * chars_per_token
-
-    chunks = []
-    start = 0
-    while start < len(text):
-        end = min(start + chunk_size, len(text))
-        chunks.append(text[start:end])
-        start += chunk_size - overlap
-    return chunks
+def _last_whitespace(data):
+    return max(data.rfind(b" "), data.rfind(b"\n"))
+
+def _char_start(data, pos):
+    # Steps back off UTF-8 continuation bytes so a cut never splits a character
+    while pos > 0 and data[pos] & 0xC0 == 0x80:
+        pos -= 1
+    return pos
+
+def _next_word_start(data, start, end):
+    hits = [i for i in (data.find(b" ", start, end), data.find(b"\n", start, end)) if i != -1]
+    return min(hits) + 1 if hits else _char_start(data, start)
+
+def iter_chunks(file_obj, chunk_size_tokens=35000, overlap_tokens=500):
+    # Yields overlapping windows read straight from file_obj (opened in binary
+    # mode), so only one chunk (plus the overlap carried over) is ever held in
+    # memory. Chunk ends and overlap starts are snapped to whitespace so no word
+    # is cut in half at either edge of a window; the search runs on bytes so
+    # rfind/find scan in C, and only the yielded chunk is decoded.
+    bytes_per_token = 4  # heuristic
+    chunk_size = chunk_size_tokens * bytes_per_token
+    overlap = overlap_tokens * bytes_per_token
+
+    buf = b""
+    carried = 0  # leading bytes of buf already sent in the previous chunk
+    while True:
+        buf += file_obj.read(chunk_size - len(buf))
+        if len(buf) <= carried:
+            break
+        if len(buf) < chunk_size:
+            yield buf.decode("utf-8", errors="replace")
+            break
+
+        cut = _last_whitespace(buf)
+        if cut <= overlap:
+            cut = _char_start(buf, len(buf) - 1)  # no usable whitespace, fall back to a hard cut
+        yield buf[:cut].decode("utf-8", errors="replace")
+
+        start = _next_word_start(buf, cut - overlap, cut)
+        carried = cut - start
+        buf = buf[start:]
 
 # -------------------------
 # Scaling function for master summary
@@ -107,23 +481,63 @@ def target_master_length(story_tokens):
     else:
         return "Target length: 12–15 pages (~6000–9000 words)."
 
+# -------------------------
+# File output
+# -------------------------
+def write_text(path, text):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text)
+
+def stream_to_file(client, path, prompt, **kwargs):
+    # Streams the response into <path>.part while it is being generated and
+    # moves it over path only once the backend has finished. Returns the full
+    # text, or "" if the stream failed, leaving no partial file behind.
+    # Leading and trailing whitespace is trimmed the way chat() strips, so the
+    # file, the return value and the cached response are the same text.
+    tmp_path = f"{path}.part"
+    parts = []
+    held = ""  # trailing whitespace, written only once more content follows it
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for piece in client.chat_stream(prompt, **kwargs):
+                text = held + piece if parts else piece.lstrip()
+                body = text.rstrip()
+                held = text[len(body):]
+                if body:
+                    f.write(body)
+                    f.flush()
+                    parts.append(body)
+        if parts:
+            os.replace(tmp_path, path)
+    except StreamInterrupted:
+        return ""
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return "".join(parts)
+
 # -------------------------
 # Recursive summarization
 # -------------------------
-def recursive_summarize(texts, client, detail_instruction, context_limit, level=0):
-    combined = "\n\n".join(texts)
-    token_estimate = len(combined) // 4
+# Fixed header for every group call; the variable summaries are only ever appended after it
+GROUP_PROMPT_HEADER = "Combine the following summaries into one coherent summary."
+
+async def recursive_summarize(texts, client, detail_instruction, context_limit, level=0, out_path=None):
+    # Size of the "\n\n"-joined text, without building it
+    total_chars = sum(len(t) for t in texts) + 2 * (len(texts) - 1)
+    token_estimate = total_chars // 4
 
     if token_estimate < context_limit * 0.8:
-        prompt = (
-            f"Combine the following summaries into one coherent summary. "
-            f"{detail_instruction}\n\n{combined}"
-        )
+        combined = "\n\n".join(texts)
+        prompt = f"{GROUP_PROMPT_HEADER} {detail_instruction}\n\nSUMMARIES:\n{combined}"
         print(f"\n🔄 Final summarization at recursion level {level}, tokens ≈ {token_estimate}")
-        return client.chat(prompt,
-                           max_tokens=int(context_limit * 0.9),
-                           temperature=0.2,
-                           system_prompt=BASE_SYSTEM_PROMPT + "/think")
+        kwargs = dict(max_tokens=min(int(context_limit * 0.9), max(1024, token_estimate)),
+                      temperature=0.2,
+                      system_prompt=SYS_THINK)
+        if out_path:
+            # Streamed straight to disk; run in a thread to keep the event loop free
+            return await asyncio.to_thread(stream_to_file, client, out_path, prompt, **kwargs)
+        return await client.chat_async(prompt, **kwargs)
 
     group_size = max(5, context_limit // 2000)
     groups = [texts[i:i + group_size] for i in range(0, len(texts), group_size)]
@@ -131,27 +545,97 @@ def recursive_summarize(texts, client, detail_instruction, context_limit, level=
     print(f"\n Text too large (≈{token_estimate} tokens). "
           f"Breaking into {len(groups)} groups at recursion level {level}...")
 
-    higher_level_summaries = []
-    for i, group in enumerate(groups, start=1):
-        print(f"  • Summarizing group {i}/{len(groups)} at level {level}...")
+    async def _run(i, group):
         combined_group = "\n\n".join(group)
-        prompt = f"Combine the following summaries into one coherent summary:\n\n{combined_group}"
-        group_summary = client.chat(prompt,
-                                    max_tokens=int(context_limit * 0.8),
-                                    temperature=0.1,
-                                    system_prompt=BASE_SYSTEM_PROMPT + "/nothink")
-        higher_level_summaries.append(group_summary)
-
-    return recursive_summarize(higher_level_summaries, client, detail_instruction, context_limit, level + 1)
+        prompt = f"{GROUP_PROMPT_HEADER}\n\nSUMMARIES:\n{combined_group}"
+        group_summary = await client.chat_async(prompt,
+                                                max_tokens=int(context_limit * 0.8),
+                                                temperature=0.1,
+                                                system_prompt=SYS_NOTHINK)
+        print(f"  • Summarized group {i}/{len(groups)} at level {level}")
+        return group_summary
+
+    higher_level_summaries = await gather_bounded(
+        [_run(i, group) for i, group in enumerate(groups, start=1)],
+        limit=min(client.concurrency, len(groups)))
+
+    # A missing group would silently drop part of the story from the summary
+    failed = [i for i, summary in enumerate(higher_level_summaries, start=1) if not summary]
+    if failed:
+        print(f"ERROR - {len(failed)} group(s) at level {level} could not be summarized "
+              f"({', '.join(map(str, failed))}). Stopping.")
+        return ""
+
+    return await recursive_summarize(higher_level_summaries, client, detail_instruction, context_limit,
+                                     level + 1, out_path)
+
+
+async def _recursive_summarize_main(texts, client, detail_instruction, context_limit, out_path=None):
+    # Entry point for asyncio.run(): closes the shared async session before the loop exits
+    async with client:
+        return await recursive_summarize(texts, client, detail_instruction, context_limit, out_path=out_path)
 
 # -------------------------
 # Summarization function
 # -------------------------
-def summarize_story(filename: str, context_limit: int, keep_flag: bool, client: LLMClient):
-    with open(filename, "r", encoding="utf-8", errors="replace") as f:
-        story_text = f.read()
+# Constant head of every chunk prompt; only the chunk text is appended
+CHUNK_PROMPT_HEAD = (
+    "Write a detailed summary of the following text, "
+    "focusing on key events, character actions, and relationships. "
+    "Capture the key events and character milestones, in chronological order.\n\n"
+    "Text:\n"
+)
+
+async def _write_entries(write_q, chunks_file):
+    # Formats chunk summaries in chunk order as they arrive on write_q and
+    # writes them to chunks_file (if any), so request tasks never wait on disk.
+    # Out-of-order arrivals are held until the chunks before them are in.
+    entries = []
+    pending = {}
+    next_i = 1
+    while True:
+        item = await write_q.get()
+        if item is None:
+            break
+        i, summary = item
+        pending[i] = summary
+        while next_i in pending:
+            entry = f"--- Chunk {next_i} ---\n{pending.pop(next_i)}\n\n"
+            entries.append(entry)
+            if chunks_file:
+                chunks_file.write(entry)
+            next_i += 1
+        if chunks_file:
+            chunks_file.flush()
+    return entries
+
+
+async def _summarize_chunks(client, prompts, chunks_file, **kwargs):
+    # Returns the formatted chunk entries and the numbers of the chunks that failed
+    write_q = asyncio.Queue()
+    writer_task = asyncio.create_task(_write_entries(write_q, chunks_file))
+    failed = []
+
+    def on_done(i, summary):
+        if not summary:
+            failed.append(i)
+        write_q.put_nowait((i, summary))
+        print(f"{i}", end=" ", flush=True)
+
+    try:
+        async with client:
+            await client.chat_many(prompts, on_done=on_done, **kwargs)
+    finally:
+        write_q.put_nowait(None)
+    return await writer_task, sorted(failed)
 
-    token_estimate = len(story_text) // 4
+
+def summarize_story(filename: str, context_limit: int, keep_flag: bool, client: LLMClient,
+                    out_path: str = None):
+    # When out_path is given, the master summary is streamed into that file as it is generated
+    # Size on disk decides one-pass vs chunking without reading the file
+    bytes_on_disk = os.path.getsize(filename)
+    token_estimate = bytes_on_disk // 4
 
     master_instruction = (
         "Write a detailed summary of the following story. "
@@ -163,65 +647,77 @@ def summarize_story(filename: str, context_limit: int, keep_flag: bool, client:
     # Case 1: Entire story fits
     if token_estimate < context_limit * 0.8:
         print(f"  Strategy: One-pass injection (≈{token_estimate} tokens). Skipping chunking.")
+        with open(filename, "r", encoding="utf-8", errors="replace") as f:
+            story_text = f.read()
         prompt = f"{master_instruction}\n\n{story_text}"
-        return client.chat(prompt,
-                           max_tokens=int(context_limit * 0.9),
-                           temperature=0.2,
-                           system_prompt=BASE_SYSTEM_PROMPT + "/think"), story_text
+        kwargs = dict(max_tokens=int(context_limit * 0.9),
+                      temperature=0.2,
+                      system_prompt=SYS_THINK)
+        if out_path:
+            return stream_to_file(client, out_path, prompt, **kwargs)
+        return client.chat(prompt, **kwargs)
 
     # Case 2: Chunking needed
     CHUNK_SIZE = int(0.75 * context_limit)
-    chunks = chunk_text(story_text, chunk_size_tokens=CHUNK_SIZE, overlap_tokens=500)
+    OVERLAP = 500
+    chunk_estimate = max(1, -(-(token_estimate - OVERLAP) // (CHUNK_SIZE - OVERLAP)))
     print(f"  Strategy: Chunking required (story ≈{token_estimate} tokens).")
-    print(f"   Using chunk size: {CHUNK_SIZE} tokens → {len(chunks)} chunks.")
+    print(f"   Using chunk size: {CHUNK_SIZE} tokens → ~{chunk_estimate} chunks.")
 
-    # Initialize the file for the chunk summaries
-    chunks_filename = None
+    # Initialize the file for the chunk summaries; kept open for the whole run
+    chunks_file = None
     if keep_flag:
         base_name = os.path.splitext(os.path.basename(filename))[0]
         chunks_filename = f"chunk_summaries_{base_name}.txt"
 
         print(f"Writing chunk summaries to {chunks_filename}. \n")
-        with open(chunks_filename, "w", encoding="utf-8") as f:
-            f.write(f"Chunk summaries for {filename}\n\n")
-
-    chunk_summaries = []
-    print("Processing chunks:", end=" ", flush=True)
-
-    for i, chunk in enumerate(chunks, start=1):
-        prompt = (
-            "Write a detailed summary of the following text, "
-            "focusing on key events, character actions, and relationships. "
-            "Capture the key events and character milestones, in chronological order.\n\n"
-            f"Text:\n{chunk}"
-        )
-        summary = client.chat(
-            prompt,
-            max_tokens=int(context_limit * 0.25),
-            temperature=0,
-            system_prompt="/nothink" + BASE_SYSTEM_PROMPT
-        )
+        chunks_file = open(chunks_filename, "w", encoding="utf-8", buffering=1 << 16)
+        chunks_file.write(f"Chunk summaries for {filename}\n\n")
 
-        entry = f"--- Chunk {i} ---\n{summary}\n\n"
-        chunk_summaries.append(entry)
+    def chunk_budget(prompt):
+        # Scale the generation budget to the chunk; the last chunk is often short.
+        # Measured in UTF-8 bytes, the same unit iter_chunks and the token estimate use
+        chunk_tokens = (len(prompt.encode()) - len(CHUNK_PROMPT_HEAD.encode())) // 4
+        return min(int(context_limit * 0.25), max(256, chunk_tokens // 2))
 
-        if keep_flag and chunks_filename:
-            with open(chunks_filename, "a", encoding="utf-8") as f:
-                f.write(entry)
+    print("Processing chunks:", end=" ", flush=True)
 
-        print(f"{i}", end=" ", flush=True)
+    try:
+        with open(filename, "rb") as f:
+            prompts = (
+                CHUNK_PROMPT_HEAD + chunk
+                for chunk in iter_chunks(f, chunk_size_tokens=CHUNK_SIZE, overlap_tokens=OVERLAP)
+            )
+            chunk_summaries, failed = asyncio.run(_summarize_chunks(
+                client,
+                prompts,
+                chunks_file,
+                batch_size=4 if client.supports_batch else 1,
+                max_tokens=chunk_budget,
+                temperature=0,
+                system_prompt=SYS_NOTHINK
+            ))
+    finally:
+        if chunks_file:
+            chunks_file.close()
+
+    # A missing chunk would silently drop part of the story from the summary
+    if failed:
+        print(f"\nERROR - {len(failed)} chunk(s) could not be summarized "
+              f"({', '.join(map(str, failed))}). Stopping.")
+        return ""
 
     print("\nAll chunks processed, creating final master summary...")
-    final_summary = recursive_summarize(chunk_summaries, client, master_instruction, context_limit)
+    final_summary = asyncio.run(
+        _recursive_summarize_main(chunk_summaries, client, master_instruction, context_limit, out_path))
 
-    combined_text = "\n\n".join(chunk_summaries)
-    return final_summary, combined_text
+    return final_summary
 
 # -------------------------
 # Main
 # -------------------------
 if __name__ == "__main__":
-    summary_level, filename, keep_flag, context_limit, base_url, model = parse_arguments()
+    summary_level, filename, keep_flag, context_limit, base_url, model, batch, concurrency = parse_arguments()
     base_name = os.path.splitext(os.path.basename(filename))[0]
 
     print(f"\n Configuration validated:")
@@ -231,56 +727,64 @@ if __name__ == "__main__":
     print(f"   • Backend URL: {base_url}")
     print(f"   • Model: {model}\n")
 
-    client = LLMClient(base_url=base_url, model=model)
-
-    start_time = datetime.now()
-    print(f"Summarization started at {start_time.strftime('%Y-%m-%d %H:%M')}\n")
+    client = LLMClient(base_url=base_url, model=model, batch=batch, concurrency=concurrency)
 
-    master_summary, combined_text = summarize_story(filename, context_limit, keep_flag, client)
+    # Always close the client, so the on-disk cache is flushed even if the run fails
+    try:
+        start_perf = time.perf_counter()
+        print(f"Summarization started at {datetime.now().strftime('%Y-%m-%d %H:%M')}\n")
 
-    if not master_summary.strip():
-        print("ERROR - No summary was generated. Skipping file output.")
-    else:
-        # Always write full master summary
+        # Always write full master summary; it is streamed to disk as it is generated
         full_summary_filename = f"Full_Summary_{base_name}.txt"
-        with open(full_summary_filename, "w", encoding="utf-8") as f:
-            f.write(master_summary)
-
-        full_word_count = len(master_summary.split())
-        print(f"\n Full master summary written to {full_summary_filename}")
-        print(f"   • Length: {full_word_count} words\n")
-
-        # If requested level < 5, compress the master
-        if summary_level < 5:
-            level_instructions = {
-                1: "Summarize the following into 3–4 paragraphs.",
-                2: "Summarize the following into 7–8 paragraphs.",
-                3: "Summarize the following into about 1,500 words.",
-                4: "Summarize the following into about 2,500 words.",
-            }
-            compress_instruction = level_instructions[summary_level]
-            compress_prompt = (
-                f"Summarize the following long summary into a shorter version.\n"
-                f"{compress_instruction}\n\n{master_summary}"
-            )
-            short_summary = client.chat(
-                compress_prompt,
-                max_tokens=int(context_limit * 0.5),
-                temperature=0.2,
-                system_prompt=BASE_SYSTEM_PROMPT + "/think"
-            )
-
-            if not short_summary.strip():
-                print("CAUTION:  Compression step failed, no shorter summary generated.")
-            else:
-                summary_filename = f"Summary_{base_name}.txt"
-                with open(summary_filename, "w", encoding="utf-8") as f:
-                    f.write(short_summary)
-
-                short_word_count = len(short_summary.split())
-                print(f" Compressed summary written to {summary_filename}")
-                print(f"   • Length: {short_word_count} words\n")
-
-    end_time = datetime.now()
-    print(f"Finished summarizing at {end_time.strftime('%Y-%m-%d  %H:%M')}\n")
+        master_summary = summarize_story(filename, context_limit, keep_flag, client, full_summary_filename)
+
+        if not master_summary.strip():
+            print("ERROR - No summary was generated. Skipping file output.")
+        else:
+            full_word_count = len(master_summary.split())
+            print(f"\n Full master summary written to {full_summary_filename}")
+            print(f"   • Length: {full_word_count} words\n")
+
+            # If requested level < 5, compress the master
+            if summary_level < 5:
+                level_instructions = {
+                    1: "Summarize the following into 3–4 paragraphs.",
+                    2: "Summarize the following into 7–8 paragraphs.",
+                    3: "Summarize the following into about 1,500 words.",
+                    4: "Summarize the following into about 2,500 words.",
+                }
+                compress_instruction = level_instructions[summary_level]
+                skip_compression = full_word_count <= TARGET_WORDS[summary_level] * 1.2
+                if skip_compression:
+                    print(" Master summary already fits the requested length, skipping compression.")
+                    short_summary = master_summary
+                else:
+                    compress_prompt = (
+                        f"Summarize the following long summary into a shorter version.\n"
+                        f"{compress_instruction}\n\n{master_summary}"
+                    )
+                    short_summary = client.chat(
+                        compress_prompt,
+                        max_tokens=int(context_limit * 0.5),
+                        temperature=0.2,
+                        system_prompt=SYS_THINK
+                    )
+
+                if not short_summary.strip():
+                    print("CAUTION:  Compression step failed, no shorter summary generated.")
+                else:
+                    summary_filename = f"Summary_{base_name}.txt"
+                    write_text(summary_filename, short_summary)
+
+                    short_word_count = len(short_summary.split())
+                    if skip_compression:
+                        print(f" Master summary copied to {summary_filename}")
+                    else:
+                        print(f" Compressed summary written to {summary_filename}")
+                    print(f"   • Length: {short_word_count} words\n")
+
+        elapsed = time.perf_counter() - start_perf
+        print(f"Finished summarizing in {elapsed:.1f}s\n")
+    finally:
+        client.close()
     print('\a'); print('\a'); print('\a')
\ No newline at end of file